@@ -29,6 +29,7 @@ install_requires=[
     'scipy',
     'tqdm',
     'h5py',
+    'numba',
     ],
 extras_require={'tests': ['pytest']},
 package_data={
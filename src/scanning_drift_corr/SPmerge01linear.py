@@ -47,6 +47,9 @@ def SPmerge01linear(scanAngles, *images, **kwargs):
         whether to show progress bars or not. Default to True.
     flagPlot : bool, optional
         whether to show plot after linear drift correction. The default is True.
+    dtype : data-type, optional
+        the floating point type of the image buffers, see sMerge. The default
+        is float.
 
     Returns
     -------
@@ -60,7 +63,7 @@ def SPmerge01linear(scanAngles, *images, **kwargs):
 
     # ignore unknown input arguments
     _args_list = ['linearSearch', 'paddingScale', 'flagReportProgress',
-                  'parallel', 'flagPlot', 'niter']
+                  'parallel', 'flagPlot', 'niter', 'dtype']
     for key in kwargs.keys():
         if key not in _args_list:
             msg = "The argument '{}' is not recognised, and it is ignored."
@@ -74,10 +77,11 @@ def SPmerge01linear(scanAngles, *images, **kwargs):
     flagPlot = kwargs.get('flagPlot', True)
     parallel = kwargs.get('parallel', True if 'linux' in sys.platform else False)
     niter = kwargs.get('niter', 2)
+    dtype = kwargs.get('dtype', float)
 
     # initialise the sMerge object
     scanAngles = np.asarray(scanAngles)
-    sm = sMerge(scanAngles, images,  paddingScale=paddingScale)
+    sm = sMerge(scanAngles, images,  paddingScale=paddingScale, dtype=dtype)
 
     # get testing linear drifts
     linearSearch *= sm.nr
@@ -198,7 +202,7 @@ def _get_linear_alignment_score(sm, linearSearch, inds, flagReportProgress,
                 tasks.append([a0, a1, sm.nr, sm.nc, sm.imageSize, sm.KDEsigma,
                               xDrift.shape, yDrift.shape, shm_scanLines01,
                               shm_scanDir01, shm_scanOr01, shm_inds,
-                              shm_xDrift, shm_yDrift])
+                              shm_xDrift, shm_yDrift, sm.scanLines.dtype])
 
         linearSearchScore = _parallel_search(linearSearch,
                                              flagReportProgress, tasks)
@@ -287,9 +291,10 @@ def _makeimage(task):
     shm_inds = task[11]
     shm_xDrift = task[12]
     shm_yDrift = task[13]
+    scanLines_dtype = task[14]
 
     # create numpy array from the shared memory blocks
-    scanLines01 = np.ndarray((2, nr, nc), dtype=float,
+    scanLines01 = np.ndarray((2, nr, nc), dtype=scanLines_dtype,
                              buffer=shm_scanLines01.buf)
     scanDir01 = np.ndarray((2, 2), dtype=float, buffer=shm_scanDir01.buf)
     inds = np.ndarray((nr, 1), dtype=float, buffer=shm_inds.buf)
@@ -3,16 +3,19 @@
 
 import sys
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.signal import convolve
+from scipy.ndimage import convolve1d
 from tqdm import tqdm
 
 from scanning_drift_corr.SPmakeImage import SPmakeImage
 from scanning_drift_corr.SPmerge02_initial import SPmerge02_initial
 from scanning_drift_corr.SPmerge02_final import SPmerge02_final
-from scanning_drift_corr.SPmerge02_phase_correlation import _globbal_phase_correlation
+from scanning_drift_corr.SPmerge02_phase_correlation import \
+    _globbal_phase_correlation, _fraction_MD
 
 def SPmerge02(sm, refineMaxSteps=None, initialRefineSteps=None, **kwargs):
     """Refinement function for scanning probe image
@@ -58,8 +61,9 @@ def SPmerge02(sm, refineMaxSteps=None, initialRefineSteps=None, **kwargs):
         zero to not use window avg. This window is relative to linear steps.
         Default to 1.
     parallel : bool, optional
-        whether to parallelise the alignment for scan lines.
-        The default is True in Linux system, else False.
+        whether to parallelise the alignment for scan lines and the
+        computation of images with multiple threads. The default is True in
+        Linux system, else False.
 
     ------------------ For global phase correlation ------------------
     flagGlobalShift : bool, optional
@@ -164,8 +168,7 @@ def SPmerge02(sm, refineMaxSteps=None, initialRefineSteps=None, **kwargs):
 
     while alignStep <= refineMaxSteps:
         # Compute all images from current origins
-        for k in range(sm.numImages):
-            sm = SPmakeImage(sm, k)
+        _remake_images(sm, parallel)
 
         # Get mean absolute difference as a fraction of the mean scanline
         # intensity.
@@ -210,10 +213,8 @@ def SPmerge02(sm, refineMaxSteps=None, initialRefineSteps=None, **kwargs):
 
     # Remake images for plotting
     if flagRemakeImage:
-        for k in (tqdm(range(sm.numImages), desc='Recomputing images',
-                       leave=False) if flagReportProgress else
-                  range(sm.numImages)):
-            sm = SPmakeImage(sm, k)
+        _remake_images(sm, parallel, desc='Recomputing images',
+                       flagReportProgress=flagReportProgress)
 
     # Get final stats
     meanAbsDiff = _fraction_MD(sm, densityCutoff)
@@ -224,6 +225,23 @@ def SPmerge02(sm, refineMaxSteps=None, initialRefineSteps=None, **kwargs):
 
     return sm
 
+def _remake_images(sm, parallel, desc=None, flagReportProgress=False):
+    """Compute all images from current origins, the images are independent
+    and are computed in threads if parallel
+    """
+
+    if parallel:
+        with ThreadPoolExecutor() as executor:
+            remade = executor.map(partial(SPmakeImage, sm),
+                                  range(sm.numImages))
+            for _ in tqdm(remade, total=sm.numImages, desc=desc, leave=False,
+                          disable=not flagReportProgress):
+                pass
+    else:
+        for k in tqdm(range(sm.numImages), desc=desc, leave=False,
+                      disable=not flagReportProgress):
+            SPmakeImage(sm, k)
+
 def _kernel_on_origin(sm, originAverage):
     """Make kernel for moving average of origins
     """
@@ -232,46 +250,39 @@ def _kernel_on_origin(sm, originAverage):
     v = np.arange(-r, r+1)
     KDEorigin = np.exp(-v**2/(2*originAverage**2))
 
-    KDEnorm = 1 / convolve(np.ones(sm.scanOr.shape),
-                           KDEorigin[:, None, None].T, 'same')
+    # the normalisation only depends on the position along the origins,
+    # broadcast to all images and x, y
+    KDEnorm = 1 / convolve1d(np.ones(sm.nr), KDEorigin, mode='constant')
 
     # need to offset 1 here??
     basisOr = np.vstack([np.zeros(sm.nr), np.arange(0, sm.nr)]) + 1
 
-    scanOrLinear = np.zeros(sm.scanOr.shape)
-    # Linear fit to scanlines
-    for k in range(sm.numImages):
-        # need to offset 1 here for scanOr?
-        ppx, *_ = np.linalg.lstsq(basisOr.T, sm.scanOr[k, 0, :]+1, rcond=None)
-        ppy, *_ = np.linalg.lstsq(basisOr.T, sm.scanOr[k, 1, :]+1, rcond=None)
-        scanOrLinear[k, 0, :] = basisOr.T @ ppx
-        scanOrLinear[k, 1, :] = basisOr.T @ ppy
-
-    # Subtract linear fit
-    sm.scanOr -= scanOrLinear
-
-    # Moving average of scanlines using KDE
-    sm.scanOr = convolve(sm.scanOr,
-                         KDEorigin[:, None, None].T, 'same') * KDEnorm
-
-    # Add linear fit back into to origins, and/or linear weighting
-    sm.scanOr += scanOrLinear
-
-def _fraction_MD(sm, densityCutoff):
-    """Get mean absolute difference as a fraction of the mean scanline
-    intensity.
-    """
-
-    imgT_mean = sm.imageTransform.mean(axis=0)
-    Idiff = np.abs(sm.imageTransform - imgT_mean).mean(axis=0)
-    dmask = sm.imageDensity.min(axis=0) > densityCutoff
-    img_mean = np.abs(sm.scanLines).mean()
-    meanAbsDiff = Idiff[dmask].mean() / img_mean
-
-    return meanAbsDiff
+    # Linear fit to scanlines, all images and x, y are fitted together as
+    # they share the same basis
+    # need to offset 1 here for scanOr?
+    data = np.vstack([sm.scanOrX, sm.scanOrY]) + 1
+    pp, *_ = np.linalg.lstsq(basisOr.T, data.T, rcond=None)
+    linear = (basisOr.T @ pp).T
+    scanOrLinearX = linear[:sm.numImages, :]
+    scanOrLinearY = linear[sm.numImages:, :]
+
+    # x and y of the origins are smoothed separately
+    for scanOr, scanOrLinear in ((sm.scanOrX, scanOrLinearX),
+                                 (sm.scanOrY, scanOrLinearY)):
+        # Subtract linear fit
+        scanOr -= scanOrLinear
+
+        # Moving average of scanlines using KDE, 1D convolution along the
+        # origins, zero padded as the 'same' convolution
+        scanOr[...] = convolve1d(scanOr, KDEorigin, axis=-1,
+                                 mode='constant') * KDEnorm
+
+        # Add linear fit back into to origins, and/or linear weighting
+        scanOr += scanOrLinear
 
 def _plot(sm):
-    imagePlot = (sm.imageTransform*sm.imageDensity).sum(axis=0)
+    # weighted sum over the images without the temporary of all images
+    imagePlot = np.einsum('kij,kij->ij', sm.imageTransform, sm.imageDensity)
     dens = sm.imageDensity.sum(axis=0)
     mask = dens > 0
     imagePlot[mask] /= dens[mask]
@@ -294,8 +305,8 @@ def _plot(sm):
 
     # put origins on plot
     for k in range(sm.numImages):
-        x = sm.scanOr[k, 1, :]
-        y = sm.scanOr[k, 0, :]
+        x = sm.scanOrY[k, :]
+        y = sm.scanOrX[k, :]
         c = cvals[k % cvals.shape[0], :]
 
         ax.plot(x, y, marker='.', markersize=12, linestyle='None', color=c)
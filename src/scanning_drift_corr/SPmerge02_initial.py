@@ -4,7 +4,7 @@
 import warnings
 
 import numpy as np
-from scipy.ndimage.morphology import binary_dilation
+from scipy.ndimage import binary_dilation
 
 from scanning_drift_corr.SPmakeImage import SPmakeImage
 
@@ -44,8 +44,8 @@ def SPmerge02_initial(sm, **kwargs):
     indStart = _get_starting_scanlines(sm, distStart)
     for k in range(sm.numImages):
         # get alignment image for the current image, based on orthogonality
-        imageAlign = _get_reference_image(sm, k, densityCutoff)
-        imageAlign = imageAlign.ravel()
+        imageAlign = np.ascontiguousarray(
+            _get_reference_image(sm, k, densityCutoff))
 
         # align origins and get the step size
         dOr = sm.scanOr[k, :, 1:] - sm.scanOr[k, :, :-1]
@@ -74,12 +74,8 @@ def SPmerge02_initial(sm, **kwargs):
 
                 # score each of the moved selected scan line against the
                 # reference image (imageAlign)
-                score = np.zeros(dxy.shape[1])
                 raw_scanline = sm.scanLines[k, m, :]
-                for p in range(dxy.shape[1]):
-                    xymove = dxy[:, p]
-                    score[p] = _get_score(sm, imageAlign, xyOr, k, xymove,
-                                          raw_scanline)
+                score = _get_score(sm, imageAlign, xyOr, k, dxy, raw_scanline)
 
                 # move the scan line
                 ind = np.argmin(score)
@@ -139,27 +135,24 @@ def _get_xyOr(sm, k, m, indsActive, xyStep):
 
     return xyOr
 
-def _get_score(sm, imageAlign, xyOr, k, xymove, raw_scanline):
-    """Refine score by moving origin of this scanline
+def _get_score(sm, imageAlign, xyOr, k, dxy, raw_scanline):
+    """Refine score by moving origin of this scanline, all the moves in dxy
+    are scored at once
     """
 
     t = np.arange(1, sm.nc+1)
     xInd = np.floor(xyOr[0] + t*sm.scanDir[k, 0] + 0.5).astype(int)
     yInd = np.floor(xyOr[1] + t*sm.scanDir[k, 1] + 0.5).astype(int)
 
-    # move the scan line
-    dx, dy = xymove
-    nxInd = xInd + dx
-    nyInd = yInd + dy
+    # move the scan line, one row for each move
+    nxInd = xInd[None, :] + dxy[0, :, None]
+    nyInd = yInd[None, :] + dxy[1, :, None]
 
     # Prevent pixels from leaving image boundaries
-    nxInd = np.core.umath.clip(nxInd, 0, sm.imageSize[0]-2).ravel()
-    nyInd = np.core.umath.clip(nyInd, 0, sm.imageSize[1]-2).ravel()    
-    # same as np.ravel_multi_index((nxInd, nyInd), sm.imageSize)
-    # but quicker, why?
-    rInd = nyInd + nxInd*sm.imageSize[-1]
+    nxInd = np.clip(nxInd, 0, sm.imageSize[0]-2)
+    nyInd = np.clip(nyInd, 0, sm.imageSize[1]-2)
 
     # calculate the score after moving the scanline
-    score = np.abs(imageAlign[rInd] - raw_scanline).sum()
+    score = np.abs(imageAlign[nxInd, nyInd] - raw_scanline).sum(axis=1)
 
     return score
@@ -2,6 +2,7 @@
 """
 
 import numpy as np
+from scipy.fft import rfft2, irfft2
 
 from scanning_drift_corr.SPmakeImage import SPmakeImage
 from scanning_drift_corr.tools import distance_transform
@@ -21,6 +22,7 @@ def _globbal_phase_correlation(sm, scanOrStep, meanAbsDiff, densityCutoff,
 
     # Align to windowed image 0 or imageRef
     smooth, imageFFT1, vecAlign = _get_ref(sm, densityCutoff, densityDist)
+    meanAbsDiffNew = meanAbsDiffCurrent
 
     # Align datasets 1 and higher to dataset 0, or align all images to imageRef
     for k in vecAlign:
@@ -36,6 +38,7 @@ def _globbal_phase_correlation(sm, scanOrStep, meanAbsDiff, densityCutoff,
         dy = (yInd + nc/2) % nc - nc/2
 
         # Only apply shift if it is larger than 2 pixels (dx+dy)
+        shiftApplied = False
         if (abs(dx) + abs(dy)) > minGlobalShift:
             shiftApplied = _apply_shift(sm, k, dx, dy)
 
@@ -45,7 +48,10 @@ def _globbal_phase_correlation(sm, scanOrStep, meanAbsDiff, densityCutoff,
 
         if not flagGlobalShiftIncrease:
             # Verify global shift did not make mean abs. diff. increase.
-            meanAbsDiffNew = _fraction_MD(sm, densityCutoff)
+            # The images only change when a shift is applied, otherwise the
+            # last value is still valid.
+            if shiftApplied:
+                meanAbsDiffNew = _fraction_MD(sm, densityCutoff)
 
             if meanAbsDiffNew < meanAbsDiffCurrent:
                 # If global shift decreased mean absolute different, keep.
@@ -60,18 +66,16 @@ def _globbal_phase_correlation(sm, scanOrStep, meanAbsDiff, densityCutoff,
 def _get_ref(sm, densityCutoff, densityDist):
     # Align to windowed image 0 or imageRef
     intensityMedian = np.median(sm.scanLines)
-    cut = sm.imageDensity[0, ...] < densityCutoff
-    min_d = np.minimum(distance_transform(cut) / densityDist, 1)
-    densityMask = np.sin(min_d * np.pi/2)**2
+    densityMask = _density_mask(sm, 0, densityCutoff, densityDist)
 
     if sm.imageRef is None:
         smooth = sm.imageTransform[0,...]*densityMask +\
             (1-densityMask)*intensityMedian
-        imageFFT1 = np.fft.fft2(smooth)
+        imageFFT1 = rfft2(smooth)
         vecAlign = range(1, sm.numImages)
     else:
         smooth = sm.imageRef*densityMask + (1-densityMask)*intensityMedian
-        imageFFT1 = np.fft.fft2(smooth)
+        imageFFT1 = rfft2(smooth)
         vecAlign = range(sm.numImages)
 
     return smooth, imageFFT1, vecAlign
@@ -83,34 +87,67 @@ def _phase_correlation(sm, k, densityCutoff, imageFFT1):
 
     # Simple phase correlation
     intensityMedian = np.median(sm.scanLines)
-    cut = sm.imageDensity[k, ...] < densityCutoff
-    min_d = np.minimum(distance_transform(cut) / 64, 1)
-    densityMask = np.sin(min_d * np.pi/2)**2
+    densityMask = _density_mask(sm, k, densityCutoff, 64)
 
     smooth = sm.imageTransform[k,...]*densityMask +\
         (1-densityMask)*intensityMedian
-    imageFFT2 = np.fft.fft2(smooth).conj()
+    imageFFT2 = rfft2(smooth).conj()
 
-    phase = np.angle(imageFFT1*imageFFT2)
-    phaseCorr = np.abs(np.fft.ifft2(np.exp(1j*phase)))
+    # the images are real, only half of the spectrum is needed
+    # normalise the cross spectrum to unit magnitude, same as
+    # exp(1j*angle(X)) without the trigonometric functions, zero gives 1
+    X = imageFFT1 * imageFFT2
+    magnitude = np.abs(X)
+    np.divide(X, magnitude, out=X, where=magnitude > 0)
+    X[magnitude == 0] = 1
+    phaseCorr = np.abs(irfft2(X, s=smooth.shape))
 
     return phaseCorr
 
+def _density_mask(sm, k, densityCutoff, densityDist):
+    """density mask of image k, smoothly going to zero near the boundaries
+
+    The distance transform is expensive and the density only changes when
+    the image is remade, the mask is cached in sm and reused if the
+    thresholded density is unchanged.
+    """
+
+    cut = sm.imageDensity[k, ...] < densityCutoff
+
+    key = (k, densityDist)
+    cached = sm._densityMaskCache.get(key)
+    if cached is not None and np.array_equal(cached[0], cut):
+        return cached[1]
+
+    # the distance transform is written to a buffer kept in sm, only the
+    # mask is cached
+    dist = distance_transform(cut, distances=sm._distanceBuffer)
+    dist /= densityDist
+    np.minimum(dist, 1, out=dist)
+    densityMask = np.sin(dist * np.pi/2)**2
+
+    # same type as the images, keep the FFTs in single precision if the
+    # images are
+    densityMask = densityMask.astype(sm.imageTransform.dtype, copy=False)
+    sm._densityMaskCache[key] = (cut, densityMask)
+
+    return densityMask
+
 def _apply_shift(sm, k, dx, dy):
     """apply the shift dx and dy, check if within image after global shift
     """
 
     # apply global origin shift, if possible
-    xNew = sm.scanOr[k, 0, :] + dx
-    yNew = sm.scanOr[k, 1, :] + dy
+    xNew = sm.scanOrX[k, :] + dx
+    yNew = sm.scanOrY[k, :] + dy
 
     # Verify shifts are within image boundaries
     nr, nc = sm.imageSize
     withinBoundary = (xNew.min() >= 0) & (xNew.max() < nr-2) &\
                      (yNew.min() >= 0) & (yNew.max() < nc-2)
     if withinBoundary:
-        sm.scanOr[k, 0, :] = xNew
-        sm.scanOr[k, 1, :] = yNew
+        sm.scanOrX[k, :] = xNew
+        sm.scanOrY[k, :] = yNew
 
         # Recompute image with new origins
         sm = SPmakeImage(sm, k)
@@ -123,7 +160,17 @@ def _fraction_MD(sm, densityCutoff):
     """
 
     imgT_mean = sm.imageTransform.mean(axis=0)
-    Idiff = np.abs(sm.imageTransform - imgT_mean).mean(axis=0)
+
+    # accumulate the absolute difference image by image, avoid a temporary
+    # array of the shape of all images
+    Idiff = np.zeros(imgT_mean.shape)
+    diff = np.empty(imgT_mean.shape)
+    for k in range(sm.numImages):
+        np.subtract(sm.imageTransform[k, ...], imgT_mean, out=diff)
+        np.abs(diff, out=diff)
+        Idiff += diff
+    Idiff /= sm.numImages
+
     dmask = sm.imageDensity.min(axis=0) > densityCutoff
     img_mean = np.abs(sm.scanLines).mean()
     meanAbsDiff = Idiff[dmask].mean() / img_mean
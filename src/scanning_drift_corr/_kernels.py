@@ -0,0 +1,182 @@
+"""The file contains the compiled kernels used in the refinement
+
+The kernels are cached (cache=True) in __pycache__ next to this file, if the
+directory is not writable numba warns and the kernels are compiled again in
+every new process.
+"""
+
+import math
+
+import numpy as np
+from numba import config, njit, prange
+
+# The TBB threading layer hangs at interpreter exit once a multiprocessing pool
+# (used in SPmerge01linear) is created after a parallel kernel is run, prefer
+# the other layers unless the user has chosen one.
+if config.THREADING_LAYER == 'default':
+    config.THREADING_LAYER_PRIORITY = ['omp', 'workqueue', 'tbb']
+
+@njit(cache=True, parallel=True)
+def refine_scanlines(imageAlign, scanLines_k, scanOrX_k, scanOrY_k, scanDir_k,
+                     step_k, dxy, nn, vParam, flagPointOrder, stepSizeReduce,
+                     imageSize):
+    """Refine the origins of all scan lines of an image against the reference
+    image, the scan lines are processed in parallel threads.
+
+    Parameters
+    ----------
+    imageAlign : ndarray
+        the reference image (two dimensional) to align against.
+    scanLines_k : ndarray
+        the raw image, each row is a scan line.
+    scanOrX_k, scanOrY_k : ndarray
+        the x and y of the scan line origins of the image.
+    scanDir_k : ndarray
+        the scanning direction of the image.
+    step_k : ndarray
+        the step size of each scan line origin, in pixels.
+    dxy : ndarray
+        the test moves of the origins, with shape (2, number of tests). The
+        first column must be no move.
+    nn : ndarray
+        the vector perpendicular to the scanning direction. Only used when
+        flagPointOrder is True.
+    vParam : ndarray
+        the parametric positions of the origins along nn. Only used when
+        flagPointOrder is True.
+    flagPointOrder : bool
+        whether to force origins to be ordered.
+    stepSizeReduce : float
+        the factor to reduce the step size of an origin which does not move.
+    imageSize : ndarray
+        the shape of the output images.
+
+    Returns
+    -------
+    scanOrX_new, scanOrY_new : ndarray
+        the x and y of the refined scan line origins.
+    step_new : ndarray
+        the updated step size of each scan line origin.
+    pixelsMoved : float
+        the total pixel shift of the origins of this image.
+    """
+
+    nr = scanLines_k.shape[0]
+    scanOrX_new = scanOrX_k.copy()
+    scanOrY_new = scanOrY_k.copy()
+    step_new = step_k.copy()
+    pshift = np.zeros(nr)
+
+    for m in prange(nr):
+        pshift[m] = _refine_scanline(m, imageAlign, scanLines_k, scanOrX_k,
+                                     scanOrY_k, scanDir_k, step_k, dxy, nn,
+                                     vParam, flagPointOrder, stepSizeReduce,
+                                     imageSize, scanOrX_new, scanOrY_new,
+                                     step_new)
+
+    return scanOrX_new, scanOrY_new, step_new, pshift.sum()
+
+@njit(cache=True)
+def refine_scanlines_serial(imageAlign, scanLines_k, scanOrX_k, scanOrY_k,
+                            scanDir_k, step_k, dxy, nn, vParam,
+                            flagPointOrder, stepSizeReduce, imageSize):
+    """Same as refine_scanlines, but the scan lines are processed serially.
+    """
+
+    nr = scanLines_k.shape[0]
+    scanOrX_new = scanOrX_k.copy()
+    scanOrY_new = scanOrY_k.copy()
+    step_new = step_k.copy()
+    pixelsMoved = 0.0
+
+    for m in range(nr):
+        pixelsMoved += _refine_scanline(m, imageAlign, scanLines_k, scanOrX_k,
+                                        scanOrY_k, scanDir_k, step_k, dxy, nn,
+                                        vParam, flagPointOrder, stepSizeReduce,
+                                        imageSize, scanOrX_new, scanOrY_new,
+                                        step_new)
+
+    return scanOrX_new, scanOrY_new, step_new, pixelsMoved
+
+@njit(cache=True)
+def _refine_scanline(m, imageAlign, scanLines_k, scanOrX_k, scanOrY_k,
+                     scanDir_k, step_k, dxy, nn, vParam, flagPointOrder,
+                     stepSizeReduce, imageSize, scanOrX_new, scanOrY_new,
+                     step_new):
+    """Refine the origin of scan line m, the new origin and step size are
+    written to scanOrX_new, scanOrY_new and step_new, returns the pixel
+    shift
+    """
+
+    nr, nc = scanLines_k.shape
+    numTest = dxy.shape[1]
+    xMax = imageSize[0] - 2
+    yMax = imageSize[1] - 2
+
+    x0 = scanOrX_k[m]
+    y0 = scanOrY_k[m]
+    step = step_k[m]
+
+    # bounds of the parametric positions from the neighbouring origins
+    vLow = -np.inf
+    vHigh = np.inf
+    if flagPointOrder:
+        if m == 0:
+            vHigh = vParam[1]
+        elif m == nr-1:
+            vLow = vParam[m-1]
+        else:
+            vLow = vParam[m-1]
+            vHigh = vParam[m+1]
+
+    ind = 0
+    scoreMin = np.inf
+    xBest = x0
+    yBest = y0
+    for p in range(numTest):
+        # move the origin, order them if required
+        xOr = x0 + dxy[0, p]*step
+        yOr = y0 + dxy[1, p]*step
+        if flagPointOrder:
+            # clamp the parametric position within the bounds, the shift is
+            # zero if it is already within
+            vTest = nn[0]*xOr + nn[1]*yOr
+            delta = min(max(vTest, vLow), vHigh) - vTest
+            xOr += nn[0]*delta
+            yOr += nn[1]*delta
+
+        # score the interpolated scan line against the raw one
+        score = 0.0
+        for t in range(nc):
+            xInd = min(max(xOr + (t+1)*scanDir_k[0], 0), xMax)
+            yInd = min(max(yOr + (t+1)*scanDir_k[1], 0), yMax)
+            xF = int(np.floor(xInd))
+            yF = int(np.floor(yInd))
+            dx = xInd - xF
+            dy = yInd - yF
+            dx1 = 1 - dx
+            dy1 = 1 - dy
+
+            imageSample = imageAlign[xF, yF]*dx1*dy1 +\
+                          imageAlign[xF+1, yF]*dx*dy1 +\
+                          imageAlign[xF, yF+1]*dx1*dy +\
+                          imageAlign[xF+1, yF+1]*dx*dy
+            score += abs(imageSample - scanLines_k[m, t])
+
+        # strict comparison, the first lowest score is kept (no move if
+        # moving origin does not change score)
+        if score < scoreMin:
+            scoreMin = score
+            ind = p
+            xBest = xOr
+            yBest = yOr
+
+    if ind == 0:
+        # Reduce the step size for this origin
+        step_new[m] = step * stepSizeReduce
+        return 0.0
+
+    scanOrX_new[m] = xBest
+    scanOrY_new[m] = yBest
+
+    return math.hypot(xBest-x0, yBest-y0)
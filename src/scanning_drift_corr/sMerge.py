@@ -23,7 +23,12 @@ class sMerge:
     scanOr : ndarray
         the xy points define the origins of the scan lines. Three dimensional
         array, with the first dim the number of images, second dim (size 2)
-        the x and y, and third dim the number of rows of input images.
+        the x and y, and third dim the number of rows of input images. It is
+        a view of scanOrX and scanOrY.
+    scanOrX, scanOrY : ndarray
+        the x and y of the origins of the scan lines, stored separately.
+        Two dimensional array, with the first dim the number of images and
+        second dim the number of rows of input images.
     scanDir : ndarray
         contains the xy vectors of which all rotated images. Two dimensional
         array, with the first dim the number of images and second dim the
@@ -58,7 +63,7 @@ class sMerge:
     """
 
     def __init__(self, scanAngles, images, KDEsigma=1/2, edgeWidth=1/128,
-                 paddingScale=1.125, imageRef=None):
+                 paddingScale=1.125, imageRef=None, dtype=float):
         """
         Parameters
         ----------
@@ -80,6 +85,11 @@ class sMerge:
         imageRef : array-like, optional
             a reference image to compare with when performing alignment. The
             default is None.
+        dtype : data-type, optional
+            the floating point type of the image buffers (scanLines,
+            imageTransform and imageDensity). np.float32 halves the memory
+            and speeds up the FFTs and reductions, the results then differ
+            slightly from MATLAB. The default is float (double precision).
         """
 
         self.KDEsigma = KDEsigma
@@ -99,28 +109,62 @@ class sMerge:
                                   self.paddingScale/4 + 0.5).astype(int) * 4
 
         # initialise scanOr and scanDir
-        self.scanOr = np.zeros((self.numImages, 2, self.nr))
+        # x and y of the origins are stored separately, as they are always
+        # used separately
+        self._scanOrXY = np.zeros((2, self.numImages, self.nr))
         self.scanDir = np.zeros((self.numImages, 2))
 
         # save raw data to scanLines
         if self.isStack:
-            self.scanLines = images[0]
+            self.scanLines = np.asarray(images[0], dtype=dtype)
         else:
-            self.scanLines = np.empty((self.numImages, *self.img_shape))
+            self.scanLines = np.empty((self.numImages, *self.img_shape),
+                                      dtype=dtype)
             for k, im in enumerate(images):
                 self.scanLines[k, :, :] = im
 
         # calculate the scan line origins
         self._set_scanOr_scanDir()
 
-        self.imageTransform = np.zeros((self.numImages, *self.imageSize))
-        self.imageDensity = np.zeros((self.numImages, *self.imageSize))
+        self.imageTransform = np.zeros((self.numImages, *self.imageSize),
+                                       dtype=dtype)
+        self.imageDensity = np.zeros((self.numImages, *self.imageSize),
+                                     dtype=dtype)
         self.linearSearchScores = None
         self.xyLinearDrift = None
         self.ref = np.floor(self.imageSize/2 + 0.5).astype(int) - 1
         self.scanActive = None
         self.stats = None
 
+        # density masks of the global phase correlation, to skip the
+        # distance transform when the density has not changed
+        self._densityMaskCache = {}
+        self._distanceBuffer = np.empty(self.imageSize)
+
+    @property
+    def scanOr(self):
+        return self._scanOrXY.transpose(1, 0, 2)
+
+    @scanOr.setter
+    def scanOr(self, value):
+        self._scanOrXY[...] = np.asarray(value).transpose(1, 0, 2)
+
+    @property
+    def scanOrX(self):
+        return self._scanOrXY[0, ...]
+
+    @scanOrX.setter
+    def scanOrX(self, value):
+        self._scanOrXY[0, ...] = value
+
+    @property
+    def scanOrY(self):
+        return self._scanOrXY[1, ...]
+
+    @scanOrY.setter
+    def scanOrY(self, value):
+        self._scanOrXY[1, ...] = value
+
     def _input_validation(self, scanAngles, images):
         """Determine whether provided images is a stack, the shapes of them
         and number of images, and some checks on input data
@@ -192,5 +236,6 @@ class sMerge:
             xy[0, :] -= xy[0, 0] % 1
             xy[1, :] -= xy[1, 0] % 1
 
-            self.scanOr[k, ...] = xy
+            self.scanOrX[k, :] = xy[0, :]
+            self.scanOrY[k, :] = xy[1, :]
             self.scanDir[k, :] = [np.cos(ang+np.pi/2), np.sin(ang+np.pi/2)]
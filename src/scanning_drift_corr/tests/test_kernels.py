@@ -0,0 +1,163 @@
+import numpy as np
+import pytest
+
+from scanning_drift_corr.sMerge import sMerge
+from scanning_drift_corr._kernels import refine_scanlines, \
+    refine_scanlines_serial
+
+DXY = np.array([[0,1,-1,0,0], [0,0,0,1,-1]])
+
+
+def _reference_refine(sm, k, scanOrStep, imageAlign, nn, vParam,
+                      flagPointOrder, stepSizeReduce):
+    """refine the origins of image k one scan line at a time in Python, as
+    performed by the original implementation of the final alignment
+    """
+
+    scanOr = sm.scanOr[k, ...].copy()
+    step = scanOrStep[k, :].copy()
+    nr, nc = sm.nr, sm.nc
+    t = np.arange(1, nc+1)
+
+    pixelsMoved = 0
+    for m in range(nr):
+        orTest = scanOr[:, m][:, None] + DXY*step[m]
+        if flagPointOrder:
+            vTest = nn[0]*orTest[0, :] + nn[1]*orTest[1, :]
+            if m == 0:
+                vBound = np.array([-np.inf, vParam[1]])
+            elif m == nr-1:
+                vBound = np.array([vParam[m-1], np.inf])
+            else:
+                vBound = np.array([vParam[m-1], vParam[m+1]])
+
+            for p in range(DXY.shape[1]):
+                if vTest[p] < vBound[0]:
+                    orTest[:, p] += nn*(vBound[0]-vTest[p])
+                elif vTest[p] > vBound[1]:
+                    orTest[:, p] += nn*(vBound[1]-vTest[p])
+
+        score = np.zeros(DXY.shape[1])
+        for p in range(DXY.shape[1]):
+            xInd = orTest[0, p] + t*sm.scanDir[k, 0]
+            yInd = orTest[1, p] + t*sm.scanDir[k, 1]
+            xInd = np.clip(xInd, 0, sm.imageSize[0]-2)
+            yInd = np.clip(yInd, 0, sm.imageSize[1]-2)
+            xF = np.floor(xInd).astype(int)
+            yF = np.floor(yInd).astype(int)
+            dx = xInd - xF
+            dy = yInd - yF
+
+            imageSample = imageAlign[xF, yF]*(1-dx)*(1-dy) +\
+                          imageAlign[xF+1, yF]*dx*(1-dy) +\
+                          imageAlign[xF, yF+1]*(1-dx)*dy +\
+                          imageAlign[xF+1, yF+1]*dx*dy
+            score[p] = np.abs(imageSample - sm.scanLines[k, m, :]).sum()
+
+        ind = np.argmin(score)
+        if ind == 0:
+            step[m] *= stepSizeReduce
+        else:
+            pixelsMoved += np.linalg.norm(orTest[:, ind] - scanOr[:, m])
+            scanOr[:, m] = orTest[:, ind]
+
+    return scanOr, step, pixelsMoved
+
+def _ordering_vectors(sm, k, flagPointOrder):
+    if flagPointOrder:
+        nn = np.array([sm.scanDir[k, 1], -sm.scanDir[k, 0]])
+        vParam = nn[0]*sm.scanOrX[k, :] + nn[1]*sm.scanOrY[k, :]
+    else:
+        nn = np.zeros(2)
+        vParam = np.zeros(sm.nr)
+
+    return nn, vParam
+
+@pytest.mark.parametrize('kernel', [refine_scanlines, refine_scanlines_serial])
+@pytest.mark.parametrize('flagPointOrder', [True, False])
+def test_refine_scanlines_random(kernel, flagPointOrder):
+    rng = np.random.default_rng(0)
+    images = rng.random((2, 16, 16))
+    sm = sMerge((0, 90), images)
+    imageAlign = rng.random(sm.imageSize)
+    stepSizeReduce = 1/2
+    k = 1
+
+    scanOrStep = rng.random((sm.numImages, sm.nr))
+    nn, vParam = _ordering_vectors(sm, k, flagPointOrder)
+
+    scanOrX_k, scanOrY_k, step_k, pixelsMoved = kernel(
+        imageAlign, sm.scanLines[k, ...], sm.scanOrX[k, :], sm.scanOrY[k, :],
+        sm.scanDir[k, :], scanOrStep[k, :], DXY, nn, vParam, flagPointOrder,
+        stepSizeReduce, sm.imageSize)
+
+    scanOr_ref, step_ref, pixelsMoved_ref = _reference_refine(
+        sm, k, scanOrStep, imageAlign, nn, vParam, flagPointOrder,
+        stepSizeReduce)
+
+    # ensure something has actually moved
+    assert pixelsMoved > 0
+    assert np.isclose(scanOrX_k, scanOr_ref[0, :]).all()
+    assert np.isclose(scanOrY_k, scanOr_ref[1, :]).all()
+    assert np.isclose(step_k, step_ref).all()
+    assert np.isclose(pixelsMoved, pixelsMoved_ref)
+
+@pytest.mark.parametrize('kernel', [refine_scanlines, refine_scanlines_serial])
+def test_refine_scanlines_ordering(kernel):
+    # the steps are larger than the spacing of the origins (1 pixel), moves
+    # perpendicular to the scan direction are clamped by the neighbours
+    rng = np.random.default_rng(1)
+    images = rng.random((2, 16, 16))
+    sm = sMerge((0, 90), images)
+    imageAlign = rng.random(sm.imageSize)
+    k = 0
+
+    scanOrStep = np.full((sm.numImages, sm.nr), 3.0)
+    nn, vParam = _ordering_vectors(sm, k, True)
+
+    scanOrX_k, scanOrY_k, step_k, pixelsMoved = kernel(
+        imageAlign, sm.scanLines[k, ...], sm.scanOrX[k, :], sm.scanOrY[k, :],
+        sm.scanDir[k, :], scanOrStep[k, :], DXY, nn, vParam, True, 1/2,
+        sm.imageSize)
+
+    scanOr_ref, step_ref, pixelsMoved_ref = _reference_refine(
+        sm, k, scanOrStep, imageAlign, nn, vParam, True, 1/2)
+
+    assert np.isclose(scanOrX_k, scanOr_ref[0, :]).all()
+    assert np.isclose(scanOrY_k, scanOr_ref[1, :]).all()
+    assert np.isclose(step_k, step_ref).all()
+    assert np.isclose(pixelsMoved, pixelsMoved_ref)
+
+    # the moved origins stay within the bounds of the neighbours, and some of
+    # them are clamped onto the bounds
+    vNew = nn[0]*scanOrX_k + nn[1]*scanOrY_k
+    vLow = np.hstack([-np.inf, vParam[:-1]])
+    vHigh = np.hstack([vParam[1:], np.inf])
+    moved = step_k == scanOrStep[k, :]
+    assert moved.any()
+    assert (vNew[moved] >= vLow[moved] - 1e-12).all()
+    assert (vNew[moved] <= vHigh[moved] + 1e-12).all()
+    onBound = np.isclose(vNew, vLow) | np.isclose(vNew, vHigh)
+    assert onBound[moved].any()
+
+@pytest.mark.parametrize('kernel', [refine_scanlines, refine_scanlines_serial])
+def test_refine_scanlines_tie(kernel):
+    # with a flat reference image and flat scan lines all test origins have
+    # the same score, the origins should not move and the steps are reduced
+    images = np.ones((2, 16, 16))
+    sm = sMerge((0, 90), images)
+    imageAlign = np.ones(sm.imageSize)
+    k = 0
+
+    scanOrStep = np.full((sm.numImages, sm.nr), 0.5)
+    nn, vParam = _ordering_vectors(sm, k, True)
+
+    scanOrX_k, scanOrY_k, step_k, pixelsMoved = kernel(
+        imageAlign, sm.scanLines[k, ...], sm.scanOrX[k, :], sm.scanOrY[k, :],
+        sm.scanDir[k, :], scanOrStep[k, :], DXY, nn, vParam, True, 1/2,
+        sm.imageSize)
+
+    assert (scanOrX_k == sm.scanOrX[k, :]).all()
+    assert (scanOrY_k == sm.scanOrY[k, :]).all()
+    assert (step_k == 0.25).all()
+    assert pixelsMoved == 0
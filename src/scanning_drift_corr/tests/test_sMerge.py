@@ -50,6 +50,32 @@ class TestInitialisation:
 
         assert np.isclose(sm.scanOr, scanOr_m).all()
 
+    def test_scanOr_view_of_scanOrXY(self, dummy_sequential_sm):
+        sm = dummy_sequential_sm
+
+        assert (sm.scanOr[:, 0, :] == sm.scanOrX).all()
+        assert (sm.scanOr[:, 1, :] == sm.scanOrY).all()
+
+        # writing to scanOr is seen by scanOrX and scanOrY and vice versa
+        sm.scanOr[1, 0, 3] = -5
+        sm.scanOrY[2, 4] = -7
+        assert sm.scanOrX[1, 3] == -5
+        assert sm.scanOr[2, 1, 4] == -7
+
+        new = np.arange(sm.scanOr.size, dtype=float).reshape(sm.scanOr.shape)
+        sm.scanOr = new
+        assert (sm.scanOrX == new[:, 0, :]).all()
+        assert (sm.scanOrY == new[:, 1, :]).all()
+
+    def test_dtype_float32(self, dummy_sequential):
+        sm = sMerge((35, 125, 60, 150), dummy_sequential, dtype=np.float32)
+
+        assert sm.scanLines.dtype == np.float32
+        assert sm.imageTransform.dtype == np.float32
+        assert sm.imageDensity.dtype == np.float32
+        # the origins stay in double precision
+        assert sm.scanOr.dtype == np.float64
+
     def test_scanDir_seq(self, dummy_sequential_sm):
         sm = dummy_sequential_sm
         assert np.isclose(np.around(sm.scanDir[0,:], 4), [-0.5736, 0.8192]).all()
@@ -4,7 +4,7 @@
 import numpy as np
 from scipy.ndimage import gaussian_filter, distance_transform_edt
 
-def distance_transform(binary_image):
+def distance_transform(binary_image, distances=None):
     """ Same as bwdist in MATLAB,  computes the Euclidean distance transform
     of the binary image. For each pixel, the distance transform assigns a
     number that is the distance between that pixel and the nearest nonzero
@@ -14,19 +14,27 @@ def distance_transform(binary_image):
     ----------
     binary_image : array-like
         the binary image
+    distances : ndarray, optional
+        a float64 array with the shape of binary_image, the distance
+        transform is written to it instead of a new array. The default is
+        None.
 
     Returns
     -------
     ndarray
-        the distance transform.
+        the distance transform, distances if it is provided.
     """
 
     binary_image = np.asarray(binary_image, dtype=bool)
+    if distances is None:
+        distances = np.empty(binary_image.shape)
 
     if np.any(binary_image):
-        return distance_transform_edt(~binary_image)
+        distance_transform_edt(~binary_image, distances=distances)
     else:
-        return np.full(binary_image.shape, np.inf)
+        distances[...] = np.inf
+
+    return distances
 
 def bilinear_interpolation(scanLines, scanOr, scanDir, imageSize,
                            indLines=None, upsampleFactor=1):